@@ -1,28 +1,73 @@
 import os
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageColor, ImageDraw, ImageFont, UnidentifiedImageError
+import numpy as np
 import io
 import base64
+import copy
+import functools
+import hashlib
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from pathlib import Path
 
+_LANCZOS = Image.Resampling.LANCZOS
+
+
+@functools.lru_cache(maxsize=8)
+def _load_config_cached(path, mtime):
+    """Parse a JSON config file once per (path, mtime)"""
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=32)
+def _get_font(name, size):
+    """Load a TrueType font once, falling back to PIL's default font"""
+    try:
+        return ImageFont.truetype(name, size)
+    except (OSError, ImportError):
+        return ImageFont.load_default()
+
+
 class BrandedImageGenerator:
     def __init__(self, config_path='config.json'):
         """Initialize the image generator with configuration"""
         self.load_config(config_path)
         self.setup_gemini()
+        self.setup_http()
+        self.build_variant_plan()
+        self.setup_save_executor()
         self.create_directories()
         
     def load_config(self, config_path):
         """Load configuration from JSON file"""
-        with open(config_path, 'r') as f:
-            self.config = json.load(f)
+        config_path = os.path.abspath(config_path)
+        # Copy the shared cached dict so generators are isolated from each
+        # other; derived state is built once at init, so later edits to
+        # self.config do not take effect
+        self.config = copy.deepcopy(_load_config_cached(config_path, os.path.getmtime(config_path)))
         
         self.brand_colors = self.config['brand']['colors']
+        self.brand_colors_rgb = np.array(
+            [ImageColor.getrgb(color)[:3] for color in self.brand_colors], dtype=np.uint8)
+        self._brand_suffix = (
+            f", {self.config['brand']['style_keywords']}, "
+            f"using colors: {', '.join(self.brand_colors)}, "
+            "professional marketing image, high quality, detailed"
+        )
         self.output_dir = self.config['storage']['output_directory']
         self.logo_path = self.config['brand'].get('logo_path', None)
+        self._logo_cache = {}
         
     def setup_gemini(self):
         """Setup Gemini API"""
@@ -32,19 +77,50 @@ class BrandedImageGenerator:
         genai.configure(api_key=api_key)
         self.model = genai.GenerativeModel('gemini-1.5-flash')
         
+        # Limit in-flight API requests to respect provider concurrency limits
+        max_concurrent = self.config['api'].get('max_concurrent_requests', 8)
+        self._api_semaphore = threading.Semaphore(max_concurrent)
+        
     def create_directories(self):
         """Create necessary output directories"""
-        Path(self.output_dir).mkdir(parents=True, exist_ok=True)
-        for size in self.config['image_variants']['sizes']:
-            Path(f"{self.output_dir}/{size['name']}").mkdir(parents=True, exist_ok=True)
+        output_dir = Path(self.output_dir)
+        dirs = {output_dir, output_dir / '.cache'}
+        dirs.update(variant_dir for _, _, _, variant_dir, _ in self._variant_plan)
+        for d in dirs:
+            d.mkdir(parents=True, exist_ok=True)
+    
+    def setup_http(self):
+        """Setup a persistent HTTP session for webhook notifications"""
+        # Only retry statuses that mean the POST was not processed, and ignore
+        # Retry-After so a server cannot stall notifications for hours
+        retry = Retry(total=3, backoff_factor=0.5,
+                      status_forcelist=[429, 503],
+                      allowed_methods=frozenset(['POST']),
+                      respect_retry_after_header=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+        self._http = requests.Session()
+        self._http.mount('http://', adapter)
+        self._http.mount('https://', adapter)
+    
+    def setup_save_executor(self):
+        """Setup a shared thread pool for encoding and writing image variants"""
+        max_workers = self.config.get('save_workers', len(self._variant_plan) or 1)
+        self._save_executor = ThreadPoolExecutor(max_workers=max_workers)
+    
+    def build_variant_plan(self):
+        """Precompute (config index, name, size, directory, format) for each image variant"""
+        variant_config = self.config['image_variants']
+        self._variant_plan = [
+            (index, size['name'], (size['width'], size['height']),
+             Path(self.output_dir) / size['name'], variant_config['format'])
+            for index, size in enumerate(variant_config['sizes'])
+        ]
+        # Largest first so smaller variants can be downsampled from larger ones
+        self._variant_plan.sort(key=lambda plan: -plan[2][0] * plan[2][1])
     
     def enhance_prompt_with_brand(self, user_prompt):
         """Enhance user prompt with brand guidelines"""
-        brand_style = self.config['brand']['style_keywords']
-        color_desc = f"using colors: {', '.join(self.brand_colors)}"
-        
-        enhanced_prompt = f"{user_prompt}, {brand_style}, {color_desc}, professional marketing image, high quality, detailed"
-        return enhanced_prompt
+        return user_prompt + self._brand_suffix
     
     def generate_image_with_gemini(self, prompt):
         """Generate image using Gemini API (text description)"""
@@ -56,35 +132,101 @@ class BrandedImageGenerator:
             # This is a placeholder that creates a colored base image
             # In production, replace with actual Gemini Imagen API call
             
+            # Reuse a previously generated base image for the same prompt
+            key = hashlib.sha256(enhanced_prompt.encode('utf-8')).hexdigest()
+            cache_path = Path(self.output_dir) / '.cache' / f"{key}.png"
+            cached = self._load_cached_image(cache_path)
+            if cached is not None:
+                print(f"Using cached image for prompt: {enhanced_prompt}")
+                return cached
+            
             print(f"Generating image with prompt: {enhanced_prompt}")
             
             # Create base image (placeholder - replace with actual API call)
-            img = self.create_base_image(enhanced_prompt)
+            def request():
+                with self._api_semaphore:
+                    return self.create_base_image(enhanced_prompt)
+            
+            img = self._with_backoff(request)
+            self._store_cached_image(img, cache_path)
             return img
             
         except Exception as e:
             print(f"Error generating image: {e}")
             return None
     
+    def _load_cached_image(self, cache_path):
+        """Load a cached base image, treating unreadable entries as a miss"""
+        if not cache_path.exists():
+            return None
+        try:
+            with Image.open(cache_path) as cached:
+                return cached.convert('RGB')
+        except (OSError, UnidentifiedImageError) as e:
+            print(f"Discarding unreadable cache entry {cache_path}: {e}")
+            try:
+                cache_path.unlink()
+            except OSError:
+                pass
+            return None
+    
+    def _store_cached_image(self, img, cache_path):
+        """Write a base image to the cache; failures are logged and skipped"""
+        tmp_path = None
+        try:
+            # Write via a unique temp file so concurrent workers and processes
+            # never leave a partially written cache entry behind
+            with tempfile.NamedTemporaryFile(dir=cache_path.parent, suffix='.tmp',
+                                             delete=False) as tmp:
+                tmp_path = tmp.name
+                img.save(tmp, 'PNG')
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Could not write cache entry {cache_path}: {e}")
+            if tmp_path:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+    
+    def _is_retryable(self, error):
+        """Check whether an API error is a transient rate-limit or server error"""
+        if isinstance(error, (google_exceptions.TooManyRequests,
+                              google_exceptions.ServerError)):
+            return True
+        status = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+        return isinstance(status, int) and (status == 429 or 500 <= status < 600)
+    
+    def _with_backoff(self, fn, max_retries=5, base=1.0, cap=30.0):
+        """Call fn, retrying 429/5xx errors with exponential backoff and jitter"""
+        for attempt in range(max_retries + 1):
+            try:
+                return fn()
+            except Exception as e:
+                if attempt == max_retries or not self._is_retryable(e):
+                    raise
+                delay = min(cap, base * 2 ** attempt) + random.uniform(0, 0.5)
+                print(f"Retryable API error ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+    
     def create_base_image(self, prompt):
         """Create a base image with brand colors (placeholder for actual generation)"""
         # This creates a gradient with brand colors as a placeholder
         # Replace this with actual Gemini Imagen API call
         
         width, height = 1024, 1024
-        img = Image.new('RGB', (width, height), color=self.brand_colors[0])
-        draw = ImageDraw.Draw(img)
         
-        # Create gradient effect
-        for i in range(height):
-            color_val = int(255 * (i / height))
-            draw.line([(0, i), (width, i)], fill=self.brand_colors[0])
+        # Create vertical gradient effect between the first two brand colors
+        start = self.brand_colors_rgb[0].astype(np.float32)
+        end = self.brand_colors_rgb[min(1, len(self.brand_colors_rgb) - 1)].astype(np.float32)
+        t = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+        rows = (start * (1 - t) + end * t).astype(np.uint8)
+        gradient = np.broadcast_to(rows[:, None, :], (height, width, 3))
+        img = Image.fromarray(np.ascontiguousarray(gradient), 'RGB')
+        draw = ImageDraw.Draw(img)
         
         # Add prompt text as overlay
-        try:
-            font = ImageFont.truetype("arial.ttf", 40)
-        except:
-            font = ImageFont.load_default()
+        font = _get_font("arial.ttf", 40)
         
         # Add text
         text = "Generated Image"
@@ -105,59 +247,90 @@ class BrandedImageGenerator:
             return img
         
         try:
-            logo = Image.open(self.logo_path).convert('RGBA')
-            
-            # Resize logo to 10% of image width
+            # Decode and resize the logo to 10% of image width once per width
             logo_width = img.width // 10
-            logo_ratio = logo_width / logo.width
-            logo_height = int(logo.height * logo_ratio)
-            logo = logo.resize((logo_width, logo_height), Image.Resampling.LANCZOS)
+            logo = self._logo_cache.get(logo_width)
+            if logo is None:
+                logo = Image.open(self.logo_path).convert('RGBA')
+                logo_ratio = logo_width / logo.width
+                logo_height = int(logo.height * logo_ratio)
+                logo = logo.resize((logo_width, logo_height), _LANCZOS)
+                self._logo_cache[logo_width] = logo
             
             # Position logo in bottom right corner
-            position = (img.width - logo_width - 20, img.height - logo_height - 20)
+            position = (img.width - logo.width - 20, img.height - logo.height - 20)
             
-            # Create a copy to paste logo
-            img_copy = img.copy().convert('RGBA')
-            img_copy.paste(logo, position, logo)
+            # Paste in place using the logo's alpha as mask; the base image
+            # is discarded by callers after branding
+            img.paste(logo, position, logo)
             
-            return img_copy.convert('RGB')
+            return img
         except Exception as e:
             print(f"Error applying logo: {e}")
             return img
     
-    def generate_variants(self, base_image, prompt_name):
+    def generate_variants(self, base_image, prompt_name, ts=None):
         """Generate multiple size variants of the image"""
-        variants = []
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        variants = [None] * len(self._variant_plan)
+        save_jobs = []
+        timestamp = (ts or datetime.now()).strftime('%Y%m%d_%H%M%S')
         
-        for size_config in self.config['image_variants']['sizes']:
-            name = size_config['name']
-            width = size_config['width']
-            height = size_config['height']
+        downscaled = []
+        vertical_passes = {}
+        for index, name, (width, height), variant_dir, fmt in self._variant_plan:
+            # Cascade only from a variant that was itself downscaled from the
+            # base, covers the target and has at least twice its area; pick
+            # the smallest such variant, otherwise resize from the base
+            candidates = [img for img in downscaled
+                          if img.width >= width and img.height >= height
+                          and img.width * img.height >= 2 * width * height]
+            source = min(candidates, key=lambda img: img.width * img.height, default=base_image)
             
-            # Resize image
-            resized_img = base_image.resize((width, height), Image.Resampling.LANCZOS)
+            if source is base_image:
+                # Lanczos is separable: run the vertical pass once per target
+                # height and share it between variants with the same height.
+                # Output is not pixel-identical to a direct resize: Pillow runs
+                # horizontal before vertical and clips the 8-bit intermediate,
+                # so edges (text, logo) can differ by a few levels
+                if height not in vertical_passes:
+                    vertical_passes[height] = base_image.resize((base_image.width, height), _LANCZOS)
+                resized_img = vertical_passes[height].resize((width, height), _LANCZOS)
+            else:
+                resized_img = source.resize((width, height), _LANCZOS)
+            if width <= base_image.width and height <= base_image.height and resized_img.size != base_image.size:
+                downscaled.append(resized_img)
             
             # Generate filename
-            filename = f"{prompt_name}_{name}_{timestamp}.{self.config['image_variants']['format']}"
-            filepath = os.path.join(self.output_dir, name, filename)
-            
-            # Save image
-            resized_img.save(filepath, quality=95)
+            filepath = str(variant_dir / f"{prompt_name}_{name}_{timestamp}.{fmt}")
             
-            variants.append({
+            save_jobs.append((resized_img, filepath, fmt))
+            # Report variants in config order regardless of processing order
+            variants[index] = {
                 'name': name,
                 'size': f"{width}x{height}",
                 'path': filepath,
                 'url': f"file://{os.path.abspath(filepath)}"
-            })
-            
-            print(f"Saved {name} variant: {filepath}")
+            }
+        
+        # Save images concurrently; JPEG encoding releases the GIL
+        list(self._save_executor.map(lambda job: self._save_variant(*job), save_jobs))
+        
+        for variant in variants:
+            print(f"Saved {variant['name']} variant: {variant['path']}")
         
         return variants
     
-    def process_prompt(self, prompt, prompt_name=None):
+    def _save_variant(self, img, filepath, fmt):
+        """Save a variant, encoding JPEGs as progressive with 4:2:0 subsampling"""
+        if fmt.lower() in ('jpg', 'jpeg'):
+            img.save(filepath, 'JPEG', quality=90, subsampling=2,
+                     progressive=True, optimize=False)
+        else:
+            img.save(filepath)
+    
+    def process_prompt(self, prompt, prompt_name=None, ts=None):
         """Process a single prompt and generate branded images"""
+        ts = ts or datetime.now()
         if not prompt_name:
             prompt_name = prompt.replace(' ', '_')[:30]
         
@@ -175,33 +348,43 @@ class BrandedImageGenerator:
         branded_image = self.apply_branding(base_image)
         
         # Generate variants
-        variants = self.generate_variants(branded_image, prompt_name)
+        variants = self.generate_variants(branded_image, prompt_name, ts=ts)
         
         result = {
             'prompt': prompt,
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': ts.isoformat(),
             'variants': variants
         }
         
         return result
     
     def batch_process(self, prompts):
-        """Process multiple prompts"""
-        results = []
+        """Process multiple prompts concurrently"""
+        results = [None] * len(prompts)
         
-        for i, prompt_data in enumerate(prompts, 1):
-            if isinstance(prompt_data, dict):
-                prompt = prompt_data['prompt']
-                name = prompt_data.get('name', f"prompt_{i}")
-            else:
-                prompt = prompt_data
-                name = f"prompt_{i}"
+        # Share one timestamp so all files from this batch sort together
+        batch_ts = datetime.now()
+        
+        with ThreadPoolExecutor(max_workers=self.config.get('concurrency', 8)) as executor:
+            futures = {}
+            for i, prompt_data in enumerate(prompts, 1):
+                if isinstance(prompt_data, dict):
+                    prompt = prompt_data['prompt']
+                    name = prompt_data.get('name', f"prompt_{i}")
+                else:
+                    prompt = prompt_data
+                    name = f"prompt_{i}"
+                
+                futures[executor.submit(self.process_prompt, prompt, name, ts=batch_ts)] = i - 1
             
-            result = self.process_prompt(prompt, name)
-            if result:
-                results.append(result)
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    print(f"Error processing prompt: {e}")
         
-        return results
+        # Preserve input order and drop failed prompts
+        return [result for result in results if result]
     
     def send_notification(self, results):
         """Send completion notification"""
@@ -212,14 +395,14 @@ class BrandedImageGenerator:
             return
         
         # Prepare notification message
-        message = "Image Generation Complete!\n\n"
+        lines = ["Image Generation Complete!", ""]
         for result in results:
-            message += f"Prompt: {result['prompt']}\n"
-            message += f"Generated at: {result['timestamp']}\n"
-            message += "Variants:\n"
-            for variant in result['variants']:
-                message += f"  - {variant['name']}: {variant['url']}\n"
-            message += "\n"
+            lines.append(f"Prompt: {result['prompt']}")
+            lines.append(f"Generated at: {result['timestamp']}")
+            lines.append("Variants:")
+            lines.extend(f"  - {variant['name']}: {variant['url']}" for variant in result['variants'])
+            lines.append("")
+        message = "\n".join(lines) + "\n"
         
         print(f"\n{'='*60}")
         print("NOTIFICATION")
@@ -230,10 +413,10 @@ class BrandedImageGenerator:
         webhook_url = notification_config.get('webhook_url')
         if webhook_url:
             try:
-                response = requests.post(webhook_url, json={
+                response = self._http.post(webhook_url, json={
                     'message': message,
                     'results': results
-                })
+                }, timeout=10)
                 print(f"Webhook notification sent: {response.status_code}")
             except Exception as e:
                 print(f"Error sending webhook: {e}")
@@ -111,7 +111,7 @@ def create_placeholder_logo():
         # Add text
         try:
             font = ImageFont.truetype("arial.ttf", 60)
-        except:
+        except (OSError, ImportError):
             font = ImageFont.load_default()
         
         text = "TB"